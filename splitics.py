@@ -8,11 +8,11 @@ It's useful when you want to migrate a calendar into Google Calendar,
 since it will only accept files that are smaller than about 1MB.
 """
 
-# This script is full of globals. Please don't program like this.
-# It's 11PM on a saturday. I'll come back and refactor it, I swear [1]
-
 import argparse
-import io
+import codecs
+import contextlib
+import mmap
+import os
 import re
 import sys
 
@@ -22,82 +22,196 @@ def parse_size(s):
     Parses a human-readable size to a number of bytes.
     Only accepts kilos and megs because seriously, there's no point in other units (not for ics files anyway).
     """
-    sizes = {
-        'K': 1024,
-        'M': 1024 * 1024,
-    }
-
-    pattern = re.compile('^(\d+)([Kk]|M)[Bb]?$')
-    match = pattern.match(s)
-    if not match:
+    # The input is a handful of characters: digits, then a unit, then an optional B (and maybe a final newline).
+    # Scanning it by hand is cheaper than going through a regex.
+    i = 0
+    while i < len(s) and s[i].isdecimal():
+        i += 1
+
+    u, b = s[i:i + 1], s[i + 1:]
+    if b.endswith('\n'):
+        b = b[:-1]
+    if i == 0 or u not in ('K', 'k', 'M') or b not in ('', 'B', 'b'):
         raise ValueError("Cannot understand size specification {}".format(s))
 
-    v, u = match.groups()
-    return int(v) * sizes[u.upper()]
+    return int(s[:i]) * (1024 if u != 'M' else 1024 * 1024)
 
 
 BEGIN_CALENDAR = "BEGIN:VCALENDAR\n"
 END_CALENDAR = "END:VCALENDAR\n"
 END_EVENT = "END:VEVENT"
 
+# The input is read in blocks of this size, and the output files are buffered in blocks of this size too
+BLOCK_SIZE = 1024 * 1024
+
+# Input files bigger than this are memory-mapped rather than read block by block
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
 
-def dump():
+def marker_encoder(encoding):
     """
-    Dumps the current stream to file.
+    Returns a function encoding markers in the given encoding.
+    The markers end up in the middle of the files, so any byte order mark
+    (like the one utf-8-sig writes) is left out: it's only emitted on the first call, which is done here.
     """
-    with open("{}.{}.ics".format(args.input.name, file_count), "w", encoding=args.encoding) as outfile:
-        outfile.write(stream.getvalue())
+    encoder = codecs.getincrementalencoder(encoding)()
+    encoder.encode("")
+    return encoder.encode
 
 
-if __name__ == '__main__':
+def check_encoding(encoding):
+    """
+    Makes sure files in the given encoding can be split.
+    The input is copied as raw bytes and only searched for the (ASCII) markers,
+    so the encoding has to write ASCII the way ASCII does: UTF-8 and Latin-1 do, UTF-16 doesn't.
+    """
+    markers = BEGIN_CALENDAR + END_CALENDAR + END_EVENT + "\r\n"
+    try:
+        ascii_compatible = marker_encoder(encoding)(markers) == markers.encode('ascii')
+    except LookupError:
+        raise ValueError("Unknown encoding {}".format(encoding))
+    except TypeError:
+        ascii_compatible = False  # Not a text encoding at all (like hex or base64)
 
-    # region Setup argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument('input', type=argparse.FileType('r'), help='The .ics input file')
-    parser.add_argument('-s', '--size', type=str, default='1M', help='Maximum size of each file (approximate)')
-    parser.add_argument('-n', '--number', type=int, default=float('inf'), help='Maximum number of events in each file')
-    parser.add_argument('-e', '--encoding', type=str, default='utf8', help='Encoding of the input file')
+    if not ascii_compatible:
+        raise ValueError("Cannot split files encoded in {} (the encoding must be ASCII-compatible)".format(encoding))
 
-    args = parser.parse_args(sys.argv[1:])
-    try:
-        args.size = parse_size(args.size)
-    except ValueError as e:
-        print(e)
-        sys.exit(1)
-    # endregion
 
-    stream = io.StringIO()
-    size, event_count, file_count = 0, 0, 0
+def open_part(name, file_count):
+    """
+    Opens the output file with the given number for the input file with the given name.
+    """
+    return open("{}.{}.ics".format(name, file_count), "wb", buffering=BLOCK_SIZE)
 
-    for line in args.input:
 
-        # Copy the file line by line, tracking the current file size
-        stream.write(line)
-        size += len(line)
+def read_blocks(infile):
+    """
+    Reads the binary stream infile as (block, start, end) tuples, where block[start:end] is the next run of lines.
+    Only the very last line can lack a newline, and block[start - 1] is always a newline
+    (the one ending the previous line, or a fake one before the first line),
+    so that every line, the first one included, follows a newline.
+    """
+    # Like reading it, mapping the input starts from where the stream currently is
+    # (e.g. when the shell has already consumed some of the standard input)
+    try:
+        position = infile.tell()
+        size = os.fstat(infile.fileno()).st_size - position
+    except (AttributeError, OSError, ValueError):
+        size = 0  # Not a real file
+
+    if size > MMAP_THRESHOLD:
+        # Big file: scan the page cache directly instead of copying it in blocks.
+        # The mapping can only be closed once the caller has released its views of it.
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            first_line = mm.find(b"\n", position) + 1 or len(mm)
+            yield b"\n" + mm[position:first_line], 1, first_line - position + 1
+            yield mm, first_line, len(mm)
+        return
+
+    # Otherwise only yield whole lines: the trailing partial line is carried over to the next block
+    carry = b"\n"
+    while True:
+        block = infile.read(BLOCK_SIZE)
+        if not block:
+            break
+
+        block = carry + block
+        end = block.rfind(b"\n") + 1
+        yield block, 1, end
+        carry = block[end - 1:]
+
+    yield carry, 1, len(carry)
+
+
+def split(infile, max_size, max_events, encoding):
+    """
+    Splits the calendar read from the binary stream infile into files,
+    rolling over after the event that takes a file over max_size bytes or to max_events events.
+    Everything the loops touch is a local variable, which is much faster to look up than a global or an attribute.
+    """
+    # The calendar's begin and end are written to every file: encode them once and for all,
+    # both with LF line endings and with CRLF ones (as RFC 5545 wants, and most calendars have)
+    encode = marker_encoder(encoding)
+    markers = {
+        False: (encode(BEGIN_CALENDAR), encode(END_CALENDAR)),
+        True: (encode(BEGIN_CALENDAR.replace("\n", "\r\n")), encode(END_CALENDAR.replace("\n", "\r\n"))),
+    }
+    # A single scan of the block finds the lines starting with the event's end (along with the newline before them).
+    # Searching for the newline rather than using ^ lets the regex engine skip ahead with a fast literal search.
+    finditer = re.compile(b"\n" + re.escape(encode(END_EVENT)) + b".*").finditer
 
-        if line.startswith(END_EVENT):
-            event_count += 1
-            if size > args.size or event_count >= args.number:
-                # Reached a rollover point: write the calendar's end and flush the file.
-                stream.write(END_CALENDAR)
+    size, event_count, file_count = 0, 0, 0
+    outfile = open_part(infile.name, file_count)
+    write = outfile.write
 
-                dump()
+    try:
+        # Go through the raw input in big blocks and only look for the events' ends,
+        # instead of decoding and re-encoding it line by line.
+        for block, start, end in read_blocks(infile):
+            # The view is released before the next block is read (which may close the block, if it is memory-mapped)
+            with memoryview(block) as view:
+                # start is the beginning of the part of the block that hasn't been written yet
+                for match in finditer(block, start - 1, end):
+                    event_count += 1
+                    eol = match.end() + 1
+                    if size + eol - start > max_size or event_count >= max_events:
+                        # Reached a rollover point: copy up to the end of the event, write the calendar's end and close the file.
+                        # The markers get the same line ending as the event's end (the match stops right before its newline).
+                        begin_calendar, end_calendar = markers[block[match.end() - 1] == 13]
+                        write(view[start:eol])
+                        write(end_calendar)
+                        outfile.close()
+
+                        # Start the next file (adding a new header for the calendar)
+                        file_count += 1
+                        outfile = open_part(infile.name, file_count)
+                        write = outfile.write
+                        write(begin_calendar)
+                        size, event_count, start = 0, 0, eol
+
+                # Copy the rest of the block, tracking the current file size
+                write(view[start:end])
+                size += end - start
+    finally:
+        # Close the last part of the file (or the one being written, if something went wrong).
+        # There's no need to add the calendar's end (the file already has it).
+        outfile.close()
+
+
+def main(argv=None):
+    """
+    Runs the script with the given command line arguments (the actual command line's by default).
+    """
+    # region Setup argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', type=argparse.FileType('rb'), help='The .ics input file')
+    parser.add_argument('-s', '--size', type=str, default='1M', help='Maximum size of each file (approximate)')
+    parser.add_argument('-n', '--number', type=int, default=float('inf'), help='Maximum number of events in each file')
+    parser.add_argument('-e', '--encoding', type=str, default='utf8', help='Encoding of the input file, which the output files keep (must be ASCII-compatible)')
 
-                # Reset the stream (adding a new header for the calendar)
-                stream = io.StringIO()
-                stream.write(BEGIN_CALENDAR)
-                size, event_count = 0, 0
+    args = parser.parse_args(argv)
+    # endregion
 
-                file_count += 1
-            else:
-                continue
+    # argparse has already opened the input: close it once done, even if the other arguments turn out to be wrong.
+    # Unless it's the standard input, which the caller may still need.
+    with args.input if args.input is not sys.stdin.buffer else contextlib.nullcontext(args.input):
+        try:
+            args.size = parse_size(args.size)
+            check_encoding(args.encoding)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
 
-    else:
-        # Finished the file, nothing to do except flushing
-        pass
+        # The input is read once from start to end: let the kernel read ahead more aggressively.
+        # Not every platform has posix_fadvise, and it fails on pipes.
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(args.input.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
 
-    # Flush the last part of the file. There's no need to add the calendar's end (the file already has it).
-    dump()
+        split(args.input, args.size, args.number, args.encoding)
 
 
-# [1] Never gonna happen
+if __name__ == '__main__':
+    main()